@@ -17,16 +17,42 @@ Protocolo:
 """
 
 import sys
+import functools
 import json
+import logging
+import re
 import struct
 import subprocess
 import os
+import socket
+from concurrent.futures import ThreadPoolExecutor, wait
+from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from datetime import datetime
+
+# orjson (python3-orjson) es opcional: si no está, se usa json de la stdlib
+try:
+    import orjson
+    
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 WHITELIST_CMD = "/usr/local/bin/whitelist"
+WHITELIST_FILE = "/var/lib/openpath/whitelist.txt"
 MAX_DOMAINS = 50
 MAX_LOG_SIZE_MB = 5
+CHECK_WORKERS = 8
+CHECK_TIMEOUT = 15
+
+# Caracteres válidos para un dominio (ya normalizado a minúsculas)
+_DOMAIN_RE = re.compile(r'\A[a-z0-9.\-]+\Z')
+
+# "activo"/"active" en la salida de `whitelist status`
+_ACTIVE_RE = re.compile(r'activ[oe]', re.IGNORECASE)
 
 def get_log_path():
     xdg_data = os.environ.get('XDG_DATA_HOME')
@@ -43,28 +69,59 @@ def get_log_path():
 
 LOG_FILE = get_log_path()
 
-def rotate_log_if_needed():
+def create_logger():
+    """Crea el logger del host con rotación por tamaño (1 copia de respaldo)"""
+    # Un error de escritura en el log nunca debe interrumpir el host
+    logging.raiseExceptions = False
+    
+    logger = logging.getLogger("openpath")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    
     try:
-        if LOG_FILE.exists() and LOG_FILE.stat().st_size > MAX_LOG_SIZE_MB * 1024 * 1024:
-            backup = LOG_FILE.with_suffix('.log.old')
-            if backup.exists():
-                backup.unlink()
-            LOG_FILE.rename(backup)
-    except Exception:
-        pass
+        handler = RotatingFileHandler(
+            LOG_FILE,
+            maxBytes=MAX_LOG_SIZE_MB * 1024 * 1024,
+            backupCount=1,
+            encoding='utf-8'
+        )
+    except OSError:
+        handler = logging.NullHandler()
+    
+    handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+    logger.addHandler(handler)
+    return logger
+
+logger = create_logger()
 
 def log_debug(message):
-    try:
-        with open(LOG_FILE, "a") as f:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            f.write(f"[{timestamp}] {message}\n")
-    except Exception:
-        pass
+    logger.info(message)
+
+def read_exact(fd, size):
+    """Lee exactamente `size` bytes del descriptor (menos si llega EOF)"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = os.read(fd, remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def write_all(fd, data):
+    """Escribe todos los bytes en el descriptor, reintentando escrituras parciales"""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
 
 def read_message():
     """Lee un mensaje del stdin en formato Native Messaging"""
-    raw_length = sys.stdin.buffer.read(4)
-    if len(raw_length) == 0:
+    stdin_fd = sys.stdin.fileno()
+    
+    raw_length = read_exact(stdin_fd, 4)
+    if len(raw_length) < 4:
         return None
     
     message_length = struct.unpack('@I', raw_length)[0]
@@ -73,21 +130,29 @@ def read_message():
     if message_length > 1024 * 1024:
         return None
     
-    message = sys.stdin.buffer.read(message_length).decode('utf-8')
-    return json.loads(message)
+    message = read_exact(stdin_fd, message_length)
+    return json_loads(message)
 
 def send_message(message):
     """Envía un mensaje al stdout en formato Native Messaging"""
-    encoded_message = json.dumps(message).encode('utf-8')
-    encoded_length = struct.pack('@I', len(encoded_message))
+    encoded_message = json_dumps(message)
     
-    sys.stdout.buffer.write(encoded_length)
-    sys.stdout.buffer.write(encoded_message)
-    sys.stdout.buffer.flush()
+    # Cabecera y cuerpo en una sola escritura
+    write_all(sys.stdout.fileno(), struct.pack('@I', len(encoded_message)) + encoded_message)
+
+def unresolved_result(domain):
+    """Resultado de un dominio sin resolución (whitelist comprobada en memoria)"""
+    return {
+        "domain": domain,
+        "in_whitelist": domain in get_whitelist_set(),
+        "resolves": False,
+        "resolved_ip": None
+    }
 
 def check_domain(domain):
     """
     Verifica si un dominio está en la whitelist y si resuelve.
+    La pertenencia se comprueba en memoria y la resolución con getaddrinfo.
     
     Returns:
         dict: {
@@ -97,64 +162,55 @@ def check_domain(domain):
             "resolved_ip": str or None
         }
     """
-    result = {
-        "domain": domain,
-        "in_whitelist": False,
-        "resolves": False,
-        "resolved_ip": None
-    }
+    result = unresolved_result(domain)
     
+    # Resolver con el resolver del sistema (dnsmasq local), sin subprocesos
     try:
-        # Ejecutar whitelist check
-        proc = subprocess.run(
-            [WHITELIST_CMD, "check", domain],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        
-        output = proc.stdout
-        
-        # Parsear resultado
-        if "SÍ" in output or "YES" in output:
-            result["in_whitelist"] = True
-        
-        if "→" in output:
-            result["resolves"] = True
-            # Extraer IP
-            import re
-            ip_match = re.search(r'→\s*(\S+)', output)
-            if ip_match:
-                result["resolved_ip"] = ip_match.group(1)
-        
-    except subprocess.TimeoutExpired:
-        log_debug(f"Timeout checking domain: {domain}")
-    except Exception as e:
-        log_debug(f"Error checking domain {domain}: {e}")
+        infos = socket.getaddrinfo(domain, None, type=socket.SOCK_STREAM)
+        result["resolves"] = True
+        result["resolved_ip"] = infos[0][4][0]
+    except socket.gaierror:
+        pass
+    except (OSError, UnicodeError) as e:
+        log_debug(f"Error resolving domain {domain}: {e}")
     
     return result
 
 def check_domains(domains):
     """Verifica múltiples dominios"""
-    results = []
+    # Limitar cantidad de dominios y sanitizar: solo caracteres válidos
+    candidates = (
+        domain.strip().lower() for domain in domains[:MAX_DOMAINS]
+        if domain and isinstance(domain, str)
+    )
+    valid_domains = [domain for domain in candidates if _DOMAIN_RE.match(domain)]
     
-    # Limitar cantidad de dominios
-    domains = domains[:MAX_DOMAINS]
+    # Cada dominio se comprueba una sola vez aunque venga repetido
+    unique_domains = list(dict.fromkeys(valid_domains))
+    if not unique_domains:
+        return []
     
-    for domain in domains:
-        # Validación básica del dominio
-        if not domain or not isinstance(domain, str):
-            continue
-        
-        # Sanitizar: solo permitir caracteres válidos para dominios
-        domain = domain.strip().lower()
-        if not all(c.isalnum() or c in '.-' for c in domain):
-            continue
-        
-        result = check_domain(domain)
-        results.append(result)
+    # Cargar la whitelist antes de repartir el trabajo entre hilos
+    get_whitelist_set()
+    
+    # getaddrinfo libera el GIL: las resoluciones se solapan entre hilos.
+    # El pool se crea solo para 'check' y se descarta al terminar el lote.
+    pool = ThreadPoolExecutor(max_workers=CHECK_WORKERS)
+    futures = {domain: pool.submit(check_domain, domain) for domain in unique_domains}
+    _, not_done = wait(futures.values(), timeout=CHECK_TIMEOUT)
+    
+    if not_done:
+        log_debug(f"Timeout checking domains: {len(not_done)} pending")
+        pool.shutdown(wait=False, cancel_futures=True)
+    else:
+        pool.shutdown()
+    
+    by_domain = {
+        domain: future.result() if future not in not_done else unresolved_result(domain)
+        for domain, future in futures.items()
+    }
     
-    return results
+    return [by_domain[domain] for domain in valid_domains]
 
 def get_whitelist_domains():
     """Obtiene la lista de dominios en la whitelist"""
@@ -162,30 +218,48 @@ def get_whitelist_domains():
         proc = subprocess.run(
             [WHITELIST_CMD, "domains"],
             capture_output=True,
-            text=True,
             timeout=10
         )
         
-        domains = [d.strip() for d in proc.stdout.split('\n') if d.strip()]
+        output = proc.stdout.decode('utf-8', 'replace')
+        domains = [d.strip() for d in output.splitlines() if d.strip()]
         return domains
         
     except Exception as e:
         log_debug(f"Error getting domains: {e}")
         return []
 
+@functools.lru_cache(maxsize=None)
+def get_whitelist_set():
+    """
+    Carga la whitelist una vez por proceso para comprobar pertenencia en memoria.
+    
+    Lee directamente el fichero que filtra `whitelist domains`, sin lanzar
+    el comando.
+    """
+    try:
+        with open(WHITELIST_FILE, encoding='utf-8', errors='replace') as f:
+            return frozenset(
+                line.strip().lower() for line in f
+                if line.strip() and not line.startswith('#')
+            )
+    except OSError as e:
+        log_debug(f"Error reading whitelist: {e}")
+        return frozenset()
+
 def get_system_status():
     """Obtiene el estado del sistema whitelist"""
     try:
         proc = subprocess.run(
             [WHITELIST_CMD, "status"],
             capture_output=True,
-            text=True,
             timeout=10
         )
         
+        output = proc.stdout.decode('utf-8', 'replace')
         return {
-            "output": proc.stdout,
-            "active": "activo" in proc.stdout.lower() or "active" in proc.stdout.lower()
+            "output": output,
+            "active": _ACTIVE_RE.search(output) is not None
         }
         
     except Exception as e:
@@ -237,7 +311,6 @@ def handle_message(message):
     
     elif action == "get-hostname":
         # Return the system hostname for token generation
-        import socket
         hostname = socket.gethostname()
         return {
             "success": True,
@@ -288,7 +361,6 @@ def handle_message(message):
         }
 
 def main():
-    rotate_log_if_needed()
     log_debug("Native host started")
     
     while True:
@@ -304,6 +376,11 @@ def main():
         
         log_debug(f"Sending: {response}")
         send_message(response)
+    
+    # Salir sin esperar a los hilos: uno bloqueado en getaddrinfo tras un
+    # timeout retrasaría la salida del proceso aunque la respuesta ya se envió
+    logging.shutdown()
+    os._exit(0)
 
 if __name__ == "__main__":
     main()